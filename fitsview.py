@@ -14,10 +14,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 from __future__ import print_function, unicode_literals, division
-import matplotlib
-matplotlib.use('Qt5Agg')
-
-from fitsview import FitsViewer
+import argparse
 import sys
 import os
 
@@ -29,7 +26,34 @@ def safe_remove(args, arg):
         pass
 
 
+def serve():
+    """
+    Run the headless tile server instead of the viewer
+    """
+    from fitsview.server import serve as run_server
+    from fitsview.memory import MemoryManager, MB
+    parser = argparse.ArgumentParser(description='Serve rendered FITS images over HTTP')
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--memory', type=int, default=1024, help='cache budget in MB')
+    parser.add_argument('--renders', type=int, default=None,
+                        help='maximum number of concurrent renders')
+    parser.add_argument('paths', nargs='+', help='FITS files or directories to serve')
+    args = parser.parse_args()
+    run_server(args.paths, host=args.host, port=args.port,
+               memory=MemoryManager(args.memory * MB), max_renders=args.renders)
+
+
 def main():
+    if '--serve' in sys.argv[1:]:
+        return serve()
+
+    # The GUI is only imported here so the server runs without Qt
+    import matplotlib
+    matplotlib.use('Qt5Agg')
+    from fitsview import FitsViewer
+
     app = FitsViewer(sys.argv)
     args = app.arguments()
 
@@ -1,2 +1,10 @@
-from .application import FitsViewer
-from .fitsview import FitsView
+# The GUI classes are imported on first use so the headless tile server can be
+# imported without Qt
+def __getattr__(name):
+    if name == 'FitsViewer':
+        from .application import FitsViewer
+        return FitsViewer
+    if name == 'FitsView':
+        from .fitsview import FitsView
+        return FitsView
+    raise AttributeError("module 'fitsview' has no attribute '{}'".format(name))
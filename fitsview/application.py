@@ -19,6 +19,8 @@ from astropy import units
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
 from functools import wraps
 from .fitsview import FitsView
+from .grid import FitsGrid
+from .memory import MB
 import simplejson as json
 import logging
 from .common import *
@@ -47,8 +49,15 @@ class FitsViewer(QtWidgets.QApplication):
         self.about_ui = uic.loadUi(get_ui_file('about.ui'))
         self.fits = FitsView()
         self.fits.hoverSignal.connect(self.updateStatus)
+        self.fits.savedSignal.connect(self.saveComplete)
+        self.fits.saveFailedSignal.connect(self.saveFailed)
+        self.fits.memorySignal.connect(self.updateMemoryStatus)
         self._session_file = None
-        ui.setCentralWidget(self.fits)
+        self.grid = FitsGrid(self.fits.memory)
+        self.views = QtWidgets.QStackedWidget()
+        self.views.addWidget(self.fits)
+        self.views.addWidget(self.grid)
+        ui.setCentralWidget(self.views)
         
         ui.setWindowIcon(QtGui.QIcon(get_ui_file('icon.svg')))
 
@@ -62,6 +71,8 @@ class FitsViewer(QtWidgets.QApplication):
         ui.colourMap.currentIndexChanged.connect(self.cmapChange)
         ui.cutUpperValue.valueChanged.connect(self.fits.setUpperCut)
         ui.cutLowerValue.valueChanged.connect(self.fits.setLowerCut)
+        ui.cutUpperValue.valueChanged.connect(self.displayChange)
+        ui.cutLowerValue.valueChanged.connect(self.displayChange)
 
         # Connect up general actions
         ui.actionOpen.triggered.connect(self.addFiles)
@@ -71,6 +82,9 @@ class FitsViewer(QtWidgets.QApplication):
         ui.actionFit_to_Window.triggered.connect(self.fits.zoomFit)
         ui.actionZoom.triggered.connect(self.fits.zoom)
         ui.actionPan.triggered.connect(self.fits.pan)
+        ui.actionFit_to_Window.triggered.connect(self.grid.zoomFit)
+        ui.actionZoom.triggered.connect(self.grid.zoom)
+        ui.actionPan.triggered.connect(self.grid.pan)
         ui.actionNext.triggered.connect(self.__next__)
         ui.actionPrevious.triggered.connect(self.previous)
         ui.actionQuit.triggered.connect(self.quit)
@@ -80,6 +94,44 @@ class FitsViewer(QtWidgets.QApplication):
         # Populate visible docks
         ui.menuDisplay.addAction(ui.displayDock.toggleViewAction())
         ui.menuDisplay.addAction(ui.fileDock.toggleViewAction())
+
+        # Grid comparison of selected files
+        ui.menu_View.addSeparator()
+        self.compare_act = QtWidgets.QAction('Compare Selected', self, checkable=True,
+                                             toggled=self.compareChange)
+        ui.menu_View.addAction(self.compare_act)
+
+        # Difference and ratio against previous or reference frames
+        self.derive_menu = ui.menu_View.addMenu('Compare Frames')
+        self.derive_group = QtWidgets.QActionGroup(self)
+        for label, mode in (('Raw', None), ('Difference', 'difference'), ('Ratio', 'ratio')):
+            act = QtWidgets.QAction(label, self, checkable=True, checked=mode is None,
+                                    triggered=self.deriveChange)
+            act.setData(mode)
+            self.derive_group.addAction(act)
+            self.derive_menu.addAction(act)
+        self.derive_menu.addSeparator()
+        self.use_reference_act = QtWidgets.QAction('Against Reference Frame', self,
+                                                   checkable=True,
+                                                   triggered=self.deriveChange)
+        self.set_reference_act = QtWidgets.QAction('Set Current as Reference', self,
+                                                   triggered=self.setReference)
+        self.align_act = QtWidgets.QAction('Align with WCS', self, checkable=True,
+                                           triggered=self.deriveChange)
+        self.derive_menu.addAction(self.use_reference_act)
+        self.derive_menu.addAction(self.set_reference_act)
+        self.derive_menu.addAction(self.align_act)
+        self._reference = None
+
+        # Memory budget options
+        ui.menu_View.addSeparator()
+        self.memory_budget_act = QtWidgets.QAction('Memory Budget...', self,
+                                                   triggered=self.setMemoryBudget)
+        self.downcast_act = QtWidgets.QAction('Downcast Images for Display', self,
+                                              checkable=True,
+                                              toggled=self.downcastChange)
+        ui.menu_View.addAction(self.memory_budget_act)
+        ui.menu_View.addAction(self.downcast_act)
         
         
         # Create recent file actions
@@ -93,6 +145,7 @@ class FitsViewer(QtWidgets.QApplication):
 
         self.aboutToQuit.connect(self.saveConfig)
         self.aboutToQuit.connect(self._autoSaveSession)
+        self.aboutToQuit.connect(QtCore.QThreadPool.globalInstance().waitForDone)
 
         
         # Connect matplot zoom/pan tools
@@ -102,9 +155,12 @@ class FitsViewer(QtWidgets.QApplication):
         self.status = QtWidgets.QLabel()
         self.status.setText('No Image Loaded')
         ui.statusBar().addWidget(self.status)
+        self.memory_status = QtWidgets.QLabel()
+        ui.statusBar().addPermanentWidget(self.memory_status)
 
         self.model = QtGui.QStandardItemModel()
         ui.fileList.setModel(self.model)
+        ui.fileList.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
 
         ui.fileList.selectionModel().selectionChanged.connect(self.setSelection)
 
@@ -112,6 +168,7 @@ class FitsViewer(QtWidgets.QApplication):
         self._load_timer = QtCore.QTimer()
         self._load_timer.setSingleShot(True)
         self._load_timer.timeout.connect(self._setFileConcrete)
+        self._load_index = None
 
         ui.show()
         ui.raise_()
@@ -132,6 +189,23 @@ class FitsViewer(QtWidgets.QApplication):
         status = '{}\t\tX: {:>4}\tY: {:>4}\tValue: {}'.format(co_str, x, y, value)
         self.status.setText(status)
 
+    def updateMemoryStatus(self, used, budget):
+        """
+        Show cache memory use in the status bar
+        """
+        self.memory_status.setText('Memory: {:.0f} / {:.0f} MB'.format(used / MB, budget / MB))
+
+    def setMemoryBudget(self):
+        """
+        Open a dialog to set the memory budget for cached images
+        """
+        memory = self.fits.memory
+        budget, ok = QtWidgets.QInputDialog.getInt(self.ui, 'Memory Budget',
+                                                   'Budget (MB):',
+                                                   memory.budget // MB, 64, 1024 * 1024)
+        if ok:
+            memory.setBudget(budget * MB)
+
     def panUpdate(self):
         self.ui.actionPan.setChecked(self.fits._mpl_toolbar._actions["pan"].isChecked())
 
@@ -140,9 +214,36 @@ class FitsViewer(QtWidgets.QApplication):
 
     def cmapChange(self, index):
         self.fits.setCMAP(get_colour_maps()[index])
+        self.displayChange()
 
     def scaleChange(self, index):
         self.fits.setScale(self.ui.normalisation.itemText(index))
+        self.displayChange()
+
+    def displayChange(self, *args):
+        """
+        Share the main view display settings with the comparison grid
+        """
+        self.grid.setRenderState(self.fits.getRenderState())
+
+    def compareChange(self, checked):
+        """
+        Switch between the single image view and the comparison grid
+        """
+        if checked:
+            self._updateGrid()
+            self.views.setCurrentWidget(self.grid)
+        else:
+            self.views.setCurrentWidget(self.fits)
+
+    def _updateGrid(self):
+        """
+        Show the selected files in the comparison grid
+        """
+        rows = sorted(i.row() for i in self.ui.fileList.selectionModel().selectedRows())
+        files = [str(self.model.item(row).fn) for row in rows]
+        if files != self.grid.getFiles():
+            self.grid.setFiles(files)
 
     def addFiles(self, *args, **kwargs):
         """
@@ -162,6 +263,9 @@ class FitsViewer(QtWidgets.QApplication):
         """
         Set the file selection
         """
+        if self.compare_act.isChecked():
+            self._updateGrid()
+            return
         try:
             self.setFile(selection[0].indexes()[0])
         except IndexError:
@@ -191,13 +295,49 @@ class FitsViewer(QtWidgets.QApplication):
         """
         index = self._load_index
         item = self.model.itemFromIndex(index)
-        self.fits.loadImage(str(item.fn))
+        mode = self.derive_group.checkedAction().data()
+        reference = None
+        if mode is not None:
+            if self.use_reference_act.isChecked():
+                reference = self._reference
+            elif index.row() > 0:
+                reference = str(self.model.item(index.row() - 1).fn)
+        if reference == str(item.fn):
+            reference = None
+        self.fits.loadImage(str(item.fn), reference=reference, mode=mode,
+                            align=self.align_act.isChecked())
         self.status.setText('')
         self.ui.infoExposureLabel.setText('{}s'.format(self.fits.getImageExposure()))
         dt = self.fits.getImageDateObserved()
         self.ui.infoDateLabel.setText(str(dt.date()))
         self.ui.infoTimeLabel.setText(str(dt.time()))
 
+    def downcastChange(self, downcast):
+        """
+        Switch downcasting of frames for display and reload the current file
+        """
+        self.fits.memory.setDowncast(downcast)
+        self.grid.setFiles(self.grid.getFiles())
+        self.deriveChange()
+
+    def deriveChange(self, *args):
+        """
+        Reload the current file with the selected comparison settings
+        """
+        if self._load_index is not None:
+            self.setFile(self._load_index)
+
+    def setReference(self):
+        """
+        Use the current file as the reference frame for comparisons
+        """
+        if self._load_index is not None:
+            self._reference = str(self.model.itemFromIndex(self._load_index).fn)
+            self.set_reference_act.setText('Set Current as Reference ({})'.format(
+                os.path.basename(self._reference)))
+            if self.use_reference_act.isChecked():
+                self.deriveChange()
+
     def setFile(self, index):
         """
         Set the file from the list to display in the main widget
@@ -310,6 +450,7 @@ class FitsViewer(QtWidgets.QApplication):
             self.ui.restoreGeometry(settings.value('geometry', self.ui.saveGeometry(), type='QByteArray'))
         except TypeError:
             pass
+        settings.endGroup()
         # Populate recent file list
         try:
             self.recent_files = settings.value('Files/recent', [], type='QStringList')
@@ -320,6 +461,14 @@ class FitsViewer(QtWidgets.QApplication):
         else:
             self.recent_files = [i for i in list(self.recent_files) if os.path.isfile(i)]
         self._updateRecentFiles()
+        # Memory budget
+        memory = self.fits.memory
+        try:
+            memory.setBudget(settings.value('Memory/budget', memory.budget // MB, type=int) * MB)
+            self.downcast_act.setChecked(settings.value('Memory/downcast', False, type=bool))
+        except TypeError:
+            pass
+        self.updateMemoryStatus(memory.usage(), memory.budget)
 
     def _updateRecentFiles(self):
         """
@@ -341,24 +490,38 @@ class FitsViewer(QtWidgets.QApplication):
         settings.setValue('geometry', self.ui.saveGeometry())
         settings.endGroup()
         settings.setValue('Files/recent', self.recent_files)
+        settings.setValue('Memory/budget', self.fits.memory.budget // MB)
+        settings.setValue('Memory/downcast', self.fits.memory.downcast)
 
     @hasImage
     def saveImage(self):
         """
         Open a dialog and save the curent fits image
         """
-        filen = QtWidgets.QFileDialog.getSaveFileName(caption='Save Fits File')
+        filen, _ = QtWidgets.QFileDialog.getSaveFileName(caption='Save Fits File')
         if filen != '':
-            self.fits.saveImage(str(filen))
-            self.status.showMessage('Saved to {}'.format(str(filen)))
+            self.fits.saveToFile(str(filen))
+            self.ui.statusBar().showMessage('Saving to {}'.format(str(filen)))
 
     @hasImage
     def exportImage(self):
         """
         Open a dialog and export the current the image
         """
-        filen = QtWidgets.QFileDialog.getSaveFileName(caption='Export to File')
-        if filen != '':
-            self.fits.saveImage(str(filen), export=True)
-            self.status.showMessage('Exported to {}'.format(str(filen)))
+        filen, _ = QtWidgets.QFileDialog.getSaveFileName(caption='Export to File')
+        if filen == '':
+            return
+        scale, ok = QtWidgets.QInputDialog.getDouble(self.ui, 'Export to File',
+                                                     'Pixels per image pixel:',
+                                                     1.0, 0.01, 100.0, 2)
+        if ok:
+            self.fits.saveToFile(str(filen), export=True, scale=scale)
+            self.ui.statusBar().showMessage('Exporting to {}'.format(str(filen)))
+
+    def saveComplete(self, filen):
+        self.ui.statusBar().showMessage('Saved to {}'.format(filen), 5000)
+
+    def saveFailed(self, filen, error):
+        logging.warning('saving {} failed: {}'.format(filen, error))
+        self.ui.statusBar().showMessage('Failed to save {}: {}'.format(filen, error))
 
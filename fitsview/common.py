@@ -16,7 +16,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 from __future__ import print_function, unicode_literals, division
 import os
 import matplotlib
-from PyQt5 import QtGui
+from PyQt5 import QtGui, QtCore
 import __main__
 
 
@@ -77,3 +77,33 @@ class FileItem(QtGui.QStandardItem):
         dn = os.path.basename(str(fn))
         super(FileItem, self).__init__(dn)
         self.fn = fn
+
+
+class TaskSignals(QtCore.QObject):
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+
+
+class BackgroundTask(QtCore.QRunnable):
+    """
+    Run a function on the global thread pool, reporting the result through
+    the finished and failed signals on the GUI thread
+    """
+    def __init__(self, func, *args, **kwargs):
+        super(BackgroundTask, self).__init__()
+        self.signals = TaskSignals()
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    def run(self):
+        try:
+            result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+    def start(self):
+        QtCore.QThreadPool.globalInstance().start(self)
+        return self
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+import math
+import numpy as np
+from astropy.wcs import WCS
+from .memory import PRIORITY_DERIVED
+
+OPERATIONS = {
+    'difference': np.subtract,
+    'ratio': np.true_divide,
+}
+
+
+def wcs_shift(header, ref_header):
+    """
+    Integer pixel offset of a reference frame relative to a frame, found by
+    projecting the frame centre through both world coordinate systems
+    header -- header of the frame
+    ref_header -- header of the reference frame
+    Returns (dy, dx) such that ref[y + dy, x + dx] matches data[y, x], or
+    (0, 0) if either header has no celestial WCS
+    """
+    try:
+        wcs, ref_wcs = WCS(header, naxis=2), WCS(ref_header, naxis=2)
+        if not (wcs.has_celestial and ref_wcs.has_celestial):
+            return 0, 0
+        y, x = (header['NAXIS2'] - 1) / 2, (header['NAXIS1'] - 1) / 2
+        world = wcs.wcs_pix2world([[x, y]], 0)
+        ref_x, ref_y = ref_wcs.wcs_world2pix(world, 0)[0]
+    except (ValueError, KeyError):
+        return 0, 0
+    if not (math.isfinite(ref_x) and math.isfinite(ref_y)):
+        return 0, 0
+    return int(round(ref_y - y)), int(round(ref_x - x))
+
+
+def combine(data, ref, mode, dy=0, dx=0):
+    """
+    Difference or ratio of a frame against a reference frame, only the
+    overlapping region is computed and everything else is NaN
+    data -- 2D image array
+    ref -- 2D reference image array
+    mode -- 'difference' or 'ratio'
+    dy, dx -- integer offset of the reference, see wcs_shift
+    Returns a new float32 array the shape of data
+    """
+    out = np.full(data.shape, np.nan, dtype=np.float32)
+    y0, y1 = max(0, -dy), min(data.shape[0], ref.shape[0] - dy)
+    x0, x1 = max(0, -dx), min(data.shape[1], ref.shape[1] - dx)
+    if y1 <= y0 or x1 <= x0:
+        return out
+    with np.errstate(divide='ignore', invalid='ignore'):
+        OPERATIONS[mode](data[y0:y1, x0:x1], ref[y0 + dy:y1 + dy, x0 + dx:x1 + dx],
+                         out=out[y0:y1, x0:x1], dtype=np.float32)
+    if mode == 'ratio':
+        out[np.isinf(out)] = np.nan
+    return out
+
+
+def derived_frame(memory, fn, reference, mode, align=False):
+    """
+    Return (data, header) of a frame combined with a reference frame. The
+    result is computed on first use from the cached decoded frames and then
+    cached itself.
+    memory -- MemoryManager holding the frames
+    fn -- full path to the image file
+    reference -- full path to the reference image file
+    mode -- 'difference' or 'ratio'
+    align -- shift the reference by whole pixels to match the frame WCS
+    """
+    key = ('derived', mode, reference, align)
+    frame = memory.get(fn, key)
+    if frame is None:
+        data, header = memory.loadFrame(fn)
+        ref, ref_header = memory.loadFrame(reference)
+        dy, dx = wcs_shift(header, ref_header) if align else (0, 0)
+        frame = (combine(data, ref, mode, dy, dx), header)
+        memory.store(fn, key, frame, PRIORITY_DERIVED)
+    return frame
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+import io
+import os
+import numpy as np
+import astropy.io.fits as fits
+import matplotlib.image
+from .render import render
+from .memory import read_image
+
+# Number of image rows handed to the FITS writer at a time
+WRITE_ROWS = 1024
+
+BITPIX = {
+    'uint8': 8,
+    'int16': 16,
+    'int32': 32,
+    'int64': 64,
+    'float32': -32,
+    'float64': -64,
+}
+
+# Types FITS can only store with an offset, as (stored type, BZERO)
+OFFSET_TYPES = {
+    'int8': ('uint8', -2 ** 7),
+    'uint16': ('int16', 2 ** 15),
+    'uint32': ('int32', 2 ** 31),
+    'uint64': ('int64', 2 ** 63),
+}
+
+
+def _stored(block):
+    """
+    Convert a block of image data to the type written to the file
+    """
+    name = block.dtype.name
+    if name == 'bool':
+        return block.astype(np.uint8)
+    if name not in OFFSET_TYPES:
+        return np.ascontiguousarray(block)
+    # Offsetting by half the range of the type only flips the sign bit
+    unsigned = np.dtype('u{}'.format(block.dtype.itemsize))
+    sign_bit = unsigned.type(1 << (8 * unsigned.itemsize - 1))
+    block = np.ascontiguousarray(block, dtype=block.dtype.newbyteorder('='))
+    return (block.view(unsigned) ^ sign_bit).view(OFFSET_TYPES[name][0])
+
+
+def write_fits(fn, data, header):
+    """
+    Write image data to a FITS file, streaming it in blocks of rows so the
+    full image is never copied or byte swapped in one go
+    fn -- output file name, overwritten if it exists
+    data -- 2D image array
+    header -- astropy header for the image
+    """
+    header = header.copy()
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    header = fits.PrimaryHDU(header=header).header
+    name = data.dtype.name
+    if name == 'bool':
+        name = 'uint8'
+    stored, bzero = OFFSET_TYPES.get(name, (name, 0))
+    header['BITPIX'] = BITPIX[stored]
+    header['NAXIS'] = data.ndim
+    last = 'NAXIS'
+    for i, n in enumerate(reversed(data.shape)):
+        key = 'NAXIS{}'.format(i + 1)
+        header.set(key, n, after=last)
+        last = key
+    if bzero:
+        header['BSCALE'] = 1
+        header['BZERO'] = bzero
+
+    # StreamingHDU appends to existing files, so clear the way first
+    if os.path.exists(fn):
+        os.remove(fn)
+    shdu = fits.StreamingHDU(fn, header)
+    try:
+        for start in range(0, data.shape[0], WRITE_ROWS):
+            shdu.write(_stored(data[start:start + WRITE_ROWS]))
+    finally:
+        shdu.close()
+
+
+def copy_image(fn, source):
+    """
+    Save the raw image data of a FITS file, as opposed to the copy decoded
+    for display
+    fn -- output file name
+    source -- full path to the image file, see read_image
+    """
+    data, header = read_image(source)
+    write_fits(fn, data, header)
+
+
+def export_image(fn, data, state, shape=None, region=None):
+    """
+    Render an image offscreen and save it, format is chosen from the extension
+    fn -- output file name
+    data -- 2D image array
+    state -- RenderState describing the cuts, stretch and colour map
+    shape -- (height, width) of the output, defaults to the region size
+    region -- (x0, x1, y0, y1) array index bounds to export, defaults to all
+    """
+    rgba = render(data, state, shape=shape, region=region)
+    if os.path.splitext(fn)[1].lower() in ('.jpg', '.jpeg'):
+        rgba = rgba[..., :3]
+    matplotlib.image.imsave(fn, rgba)
+
+
+def encode_png(rgba):
+    """
+    Encode an RGBA array as PNG
+    Returns the PNG file contents as bytes
+    """
+    buf = io.BytesIO()
+    matplotlib.image.imsave(buf, rgba, format='png')
+    return buf.getvalue()
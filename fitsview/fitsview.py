@@ -24,6 +24,10 @@ import dateutil
 from PyQt5 import QtGui, QtWidgets, QtCore
 from functools import wraps
 from .common import *
+from .export import write_fits, copy_image, export_image
+from .render import RenderState, cut_sample, sample_cuts, stretch_parameters
+from .memory import MemoryManager
+from .derived import derived_frame
 
 
 class FitsView(FigureCanvasQTAgg):
@@ -33,6 +37,9 @@ class FitsView(FigureCanvasQTAgg):
     """
     hoverSignal = QtCore.Signal(int, int, int, float, float)
     selectSignal = QtCore.Signal(object)
+    savedSignal = QtCore.Signal(str)
+    saveFailedSignal = QtCore.Signal(str, str)
+    memorySignal = QtCore.Signal(object, object)
 
     def refresh(f):
         @wraps(f)
@@ -69,6 +76,12 @@ class FitsView(FigureCanvasQTAgg):
         self._scales['Power'] = 'power'
         self._scales['Arc Sinh'] = 'arcsinh'
         self._gc = None
+        self._cut_sample = None
+        self._filename = None
+        self._source = None
+        self.memory = MemoryManager()
+        # Stores can happen on worker threads, the signal queues to the GUI
+        self.memory.addListener(self.memorySignal.emit)
         self._upperCut = 99.75
         self._lowerCut = 0.25
         self._cmap = 'gray'
@@ -76,10 +89,15 @@ class FitsView(FigureCanvasQTAgg):
         self._refresh_timer.setSingleShot(True)
         self._refresh_timer.timeout.connect(self._refreshConcrete)
         self.apertures = []
+        self._tasks = set()
 
     def _refreshConcrete(self):
         if self._gc:
-            self._gc.show_colorscale(pmin=self._lowerCut, pmax=self._upperCut,
+            # Cuts are passed explicitly so exports and other renders which
+            # use the same parameters match the display
+            vmin, vmax = sample_cuts(self._cut_sample, self._lowerCut, self._upperCut)
+            vmin, vmax, _, vmid = stretch_parameters(vmin, vmax, self._scale)
+            self._gc.show_colorscale(vmin=vmin, vmid=vmid, vmax=vmax,
                                      stretch=self._scale, aspect='auto',
                                      cmap=self._cmap)
             self._gc.axis_labels.hide()
@@ -88,13 +106,29 @@ class FitsView(FigureCanvasQTAgg):
             self._gc.frame.set_linewidth(0)
 
     @refresh
-    def loadImage(self, filename):
+    def loadImage(self, filename, reference=None, mode='difference', align=False):
         """
         Load a fits image from disk
         filename -- full path to the image file
+        reference -- optional full path to a frame to compare against
+        mode -- 'difference' or 'ratio' against the reference
+        align -- shift the reference by whole pixels to match the image WCS
         """
         self._fig.clear()
-        self._gc = aplpy.FITSFigure(filename, figure=self._fig)
+        self._gc = None
+        if self._filename is not None:
+            self.memory.unpin(self._filename)
+        self._filename = filename
+        self.memory.pin(filename)
+        # Frames shown as loaded are saved from the file, so the raw data is
+        # written rather than a copy downcast for display
+        self._source = filename if reference is None else None
+        if reference is None:
+            data, header = self.memory.loadFrame(filename)
+        else:
+            data, header = derived_frame(self.memory, filename, reference, mode, align)
+        self._gc = aplpy.FITSFigure(fits.PrimaryHDU(data, header), figure=self._fig)
+        self._cut_sample = cut_sample(self._gc._data)
 
     @refresh
     def takeImage(self, exposure, progress, dev='/dev/tty.usberial'):
@@ -109,11 +143,13 @@ class FitsView(FigureCanvasQTAgg):
         if use_camera():
             from pyallsky import AllSkyCamera
             self._fig.clear()
+            self._source = None
             self._taking = True
             cam = AllSkyCamera(dev)
             image = cam.get_image(exposure=exposure, progress_callback=progress)
             self._max = image.data.max()
             self._gc = aplpy.FITSFigure(image, figure=self._fig)
+            self._cut_sample = cut_sample(self._gc._data)
             self._taking = False
 
     def getImageDateObserved(self):
@@ -184,13 +220,62 @@ class FitsView(FigureCanvasQTAgg):
         """
         self._mpl_toolbar.pan()
 
+    def getRenderState(self):
+        """
+        Return a snapshot of the current display settings
+        """
+        return RenderState(self._lowerCut, self._upperCut, self._scale, self._cmap)
+
     @hasImage
-    def saveToFile(self, fn, export=False):
+    def getViewRegion(self):
+        """
+        Return the visible part of the image as (x0, x1, y0, y1) array bounds
+        """
+        ax = self._gc.image.axes
+        height, width = self._gc._data.shape
+        # Map axis limits through the image extent rather than assuming
+        # where a given aplpy version puts the pixel centres
+        left, right, bottom, top = self._gc.image.get_extent()
+        xs = [(x - left) / (right - left) * width for x in ax.get_xlim()]
+        ys = [(y - bottom) / (top - bottom) * height for y in ax.get_ylim()]
+        x0, x1 = [min(max(int(round(x)), 0), width) for x in sorted(xs)]
+        y0, y1 = [min(max(int(round(y)), 0), height) for y in sorted(ys)]
+        if x1 <= x0 or y1 <= y0:
+            return (0, width, 0, height)
+        return (x0, x1, y0, y1)
+
+    @hasImage
+    def saveToFile(self, fn, export=False, scale=1.0):
+        """
+        Save the current image in the background, savedSignal or
+        saveFailedSignal is emitted when done
+        fn -- output file name
+        export -- render the current view to an image instead of saving FITS
+        scale -- output pixels per image pixel when exporting
+        """
         if export:
-            self._gc.save(fn)
+            region = self.getViewRegion()
+            shape = (max(1, int(round((region[3] - region[2]) * scale))),
+                     max(1, int(round((region[1] - region[0]) * scale))))
+            task = BackgroundTask(export_image, fn, self._gc._data,
+                                  self.getRenderState(), shape=shape,
+                                  region=region)
+        elif self._source is not None:
+            task = BackgroundTask(copy_image, fn, self._source)
+        else:
+            task = BackgroundTask(write_fits, fn, self._gc._data,
+                                  self._gc._header.copy())
+        task.signals.finished.connect(lambda result: self._saveDone(task, fn))
+        task.signals.failed.connect(lambda error: self._saveDone(task, fn, error))
+        self._tasks.add(task)
+        return task.start()
+
+    def _saveDone(self, task, fn, error=None):
+        self._tasks.discard(task)
+        if error is None:
+            self.savedSignal.emit(fn)
         else:
-            hdu = fits.PrimaryHDU(self._gc._data, header=self._gc._header)
-            hdu.writeto(fn, clobber=True)
+            self.saveFailedSignal.emit(fn, error)
 
     @hasImage
     def mouseMoveEvent(self, event):
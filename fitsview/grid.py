@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QTAgg
+from matplotlib.figure import Figure
+from PyQt5 import QtWidgets, QtCore
+from functools import wraps, partial
+import itertools
+import logging
+import math
+import os
+import numpy as np
+from .render import RenderState, render, block_average, cut_sample, sample_cuts
+from .memory import PRIORITY_PYRAMID
+from .common import BackgroundTask
+
+
+class FitsGrid(FigureCanvasQTAgg):
+    """
+    Shows several FITS images in a grid with shared display settings and
+    linked zoom and pan. Previews are built in the background and panels are
+    rendered concurrently from these cached, downsampled copies of the images.
+    """
+    MaxPreviewSize = 1024
+
+    def refresh(f):
+        @wraps(f)
+        def _refresh(*args, **kwargs):
+            ret = f(*args, **kwargs)
+            args[0]._refresh_timer.start(150)
+            return ret
+        return _refresh
+
+    def hasPanels(f):
+        @wraps(f)
+        def _hasPanels(*args, **kwargs):
+            if args[0]._images:
+                return f(*args, **kwargs)
+            else:
+                return None
+        return _hasPanels
+
+    def __init__(self, memory):
+        self._fig = Figure(dpi=170)
+        FigureCanvasQTAgg.__init__(self, self._fig)
+        FigureCanvasQTAgg.setSizePolicy(self,
+                                        QtWidgets.QSizePolicy.Expanding,
+                                        QtWidgets.QSizePolicy.Expanding)
+        self._fig.subplots_adjust(left=0, right=1, top=1, bottom=0,
+                                  wspace=0.02, hspace=0.02)
+        self._mpl_toolbar = NavigationToolbar2QTAgg(self, self)
+        self._mpl_toolbar.hide()
+        self.memory = memory
+        self._executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self._files = []
+        self._previews = []
+        self._images = []
+        self._tasks = set()
+        self._generation = 0
+        self._renders = 0
+        self._stale = False
+        self._limits = None
+        self._state = RenderState(0.25, 99.75, 'log', 'gray')
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.timeout.connect(self._refreshConcrete)
+
+    def _preview(self, fn):
+        """
+        Return (preview, covered shape, cut sample) for a file from the cache,
+        building it if needed. The covered shape is the part of the full
+        resolution image the preview blocks span.
+        """
+        preview = self.memory.get(fn, 'preview')
+        if preview is None:
+            data, _ = self.memory.loadFrame(fn)
+            k = max(1, int(math.ceil(max(data.shape) / self.MaxPreviewSize)))
+            small = block_average(data, k)
+            preview = (small, (small.shape[0] * k, small.shape[1] * k), cut_sample(small))
+            self.memory.store(fn, 'preview', preview, PRIORITY_PYRAMID)
+        return preview
+
+    def _renderPanel(self, preview, state):
+        data, _, sample = preview
+        cuts = sample_cuts(sample, state.lower_cut, state.upper_cut)
+        return render(data, state, cuts=cuts)
+
+    def _renderPanels(self, previews, state):
+        return list(self._executor.map(self._renderPanel, previews,
+                                       itertools.repeat(state)))
+
+    def _refreshConcrete(self):
+        # Nothing is rendered while another view is shown, showEvent catches up
+        self._stale = not self.isVisible()
+        if self._stale:
+            return
+        ready = [(im, preview) for im, preview in zip(self._images, self._previews)
+                 if preview is not None]
+        if not ready:
+            return
+        self._renders += 1
+        task = BackgroundTask(self._renderPanels, [p for _, p in ready], self._state)
+        task.signals.finished.connect(partial(self._panelsReady, task, self._renders,
+                                              [im for im, _ in ready]))
+        task.signals.failed.connect(partial(self._renderFailed, task))
+        self._tasks.add(task)
+        task.start()
+
+    def _panelsReady(self, task, renders, images, panels):
+        self._tasks.discard(task)
+        # Only the latest render is shown, older ones finish out of order
+        if renders != self._renders:
+            return
+        for im, rgba in zip(images, panels):
+            im.set_data(rgba)
+        self.draw_idle()
+
+    def _renderFailed(self, task, error):
+        self._tasks.discard(task)
+        logging.warning('could not render comparison: {}'.format(error))
+
+    def showEvent(self, event):
+        FigureCanvasQTAgg.showEvent(self, event)
+        if self._stale:
+            self._refresh_timer.start(0)
+
+    @refresh
+    def setFiles(self, files):
+        """
+        Set the images to show, panels are laid out in reading order and
+        filled in as their previews become ready
+        files -- list of full paths to image files
+        """
+        self._files = [str(fn) for fn in files]
+        self._generation += 1
+        self._previews = [None] * len(self._files)
+        self._limits = None
+        self._fig.clear()
+        self._images = []
+        if not self._files:
+            return
+        cols = int(math.ceil(math.sqrt(len(self._files))))
+        rows = int(math.ceil(len(self._files) / cols))
+        first = None
+        for i, fn in enumerate(self._files):
+            ax = self._fig.add_subplot(rows, cols, i + 1, sharex=first, sharey=first)
+            ax.set_axis_off()
+            first = first or ax
+            blank = np.zeros((1, 1, 4), dtype=np.uint8)
+            self._images.append(ax.imshow(blank, extent=(0, 1, 0, 1),
+                                          interpolation='nearest', aspect='equal'))
+            task = BackgroundTask(self._preview, fn)
+            task.signals.finished.connect(partial(self._previewReady, task,
+                                                  self._generation, i))
+            task.signals.failed.connect(partial(self._previewFailed, task, fn))
+            self._tasks.add(task)
+            task.start()
+
+    def _previewReady(self, task, generation, i, preview):
+        self._tasks.discard(task)
+        if generation != self._generation:
+            return
+        self._previews[i] = preview
+        # Panels share full resolution pixel coordinates so zoom and pan
+        # stay linked whatever the downsampling factor
+        height, width = preview[1]
+        self._images[i].set_extent((0, width, 0, height))
+        # Fit the view to the first preview and whenever a larger one arrives,
+        # otherwise keep the current zoom and navigation history
+        limits = (height, width)
+        if self._limits is not None:
+            limits = (max(self._limits[0], height), max(self._limits[1], width))
+        if limits != self._limits:
+            self._limits = limits
+            ax = self._images[0].axes
+            ax.set_xlim(0, limits[1])
+            ax.set_ylim(0, limits[0])
+            self._mpl_toolbar.update()
+        self._refresh_timer.start(150)
+
+    def _previewFailed(self, task, fn, error):
+        self._tasks.discard(task)
+        logging.warning('could not load {} for comparison: {}'.format(fn, error))
+
+    def getFiles(self):
+        return self._files
+
+    @refresh
+    def setRenderState(self, state):
+        """
+        Set the cuts, stretch and colour map shared by every panel
+        state -- RenderState, see FitsView.getRenderState
+        """
+        self._state = state
+
+    @hasPanels
+    @refresh
+    def zoomFit(self, *args):
+        """
+        Fit images to window
+        """
+        self._mpl_toolbar.home()
+
+    @hasPanels
+    @refresh
+    def zoom(self, *args):
+        """
+        Zoom in on selected region
+        """
+        self._mpl_toolbar.zoom()
+
+    @hasPanels
+    @refresh
+    def pan(self, *args):
+        """
+        Pan around images
+        """
+        self._mpl_toolbar.pan()
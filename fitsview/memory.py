@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+from collections import OrderedDict
+import mmap
+import threading
+import numpy as np
+import astropy.io.fits as fits
+
+# Eviction priorities, lower values are evicted first
+PRIORITY_DERIVED = 0
+PRIORITY_PYRAMID = 1
+PRIORITY_FRAME = 2
+
+MB = 1024 * 1024
+
+# Nominal cost of an array mapped from disk, it still holds a file descriptor
+# and address space even though its pages can be dropped
+MAPPED_COST = 64 * 1024
+
+
+def _on_disk(array):
+    """
+    Check whether an array is backed by a memory mapped file
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def _items(value):
+    if isinstance(value, (tuple, list)):
+        return value
+    if isinstance(value, dict):
+        return value.values()
+    return None
+
+
+def sizeof(value):
+    """
+    Bytes of memory held by a cached value, arrays mapped from disk only
+    count MAPPED_COST
+    value -- array, bytes, or tuple/list/dict of arrays
+    """
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return MAPPED_COST if _on_disk(value) else value.nbytes
+    items = _items(value)
+    if items is not None:
+        return sum(sizeof(v) for v in items)
+    return getattr(value, 'nbytes', 0)
+
+
+def mapped(value):
+    """
+    Number of arrays in a cached value that are mapped from disk
+    """
+    if isinstance(value, np.ndarray):
+        return int(_on_disk(value))
+    items = _items(value)
+    if items is not None:
+        return sum(mapped(v) for v in items)
+    return 0
+
+
+# HDU types holding image data, searched in order like aplpy does
+IMAGE_HDUS = (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)
+
+
+def _read_image(fn, memmap):
+    with fits.open(fn, memmap=memmap) as hdul:
+        for hdu in hdul:
+            if isinstance(hdu, IMAGE_HDUS) and hdu.data is not None:
+                return hdu.data, hdu.header
+        return None, hdul[0].header
+
+
+def read_image(fn):
+    """
+    Read the (data, header) of the first image HDU with data and close the
+    file, data is None if there is no image. Data is mapped from disk where
+    possible, it stays valid and the mapping is released once nothing refers
+    to it.
+    fn -- full path to the image file
+    """
+    try:
+        return _read_image(fn, memmap=True)
+    except ValueError:
+        # Newer astropy refuses to map scaled (BZERO/BSCALE) data
+        return _read_image(fn, memmap=False)
+
+
+class MemoryManager(object):
+    """
+    Accounts for the memory held by decoded frames and derived products of
+    each loaded file, evicting the lowest priority, least recently used
+    entries when over budget or when too many files are mapped. Pinned files
+    are never evicted. Listeners are called with (usage, budget) whenever
+    usage changes, possibly from a worker thread.
+    """
+    MaxMapped = 64
+
+    def __init__(self, budget=1024 * MB, downcast=False):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._pinned = set()
+        self._usage = 0
+        self._mapped = 0
+        self._listeners = []
+        self.budget = budget
+        self.downcast = downcast
+
+    def addListener(self, listener):
+        """
+        Call listener(usage, budget) whenever memory use changes
+        """
+        self._listeners.append(listener)
+
+    def _notify(self):
+        for listener in self._listeners:
+            listener(self._usage, self.budget)
+
+    def setBudget(self, budget):
+        """
+        Set the memory budget and evict down to it
+        budget -- budget in bytes
+        """
+        with self._lock:
+            self.budget = budget
+            self._evict()
+        self._notify()
+
+    def setDowncast(self, downcast):
+        """
+        Convert float64 frames to float32 for display, the raw data stays on
+        disk. Everything cached is derived from the decoded frames, so it is
+        all dropped when the setting changes.
+        """
+        with self._lock:
+            if downcast == self.downcast:
+                return
+            self.downcast = downcast
+            for key in list(self._entries):
+                self._remove(key)
+        self._notify()
+
+    def usage(self, fn=None):
+        """
+        Return bytes in use, for one file if fn is given
+        """
+        with self._lock:
+            if fn is None:
+                return self._usage
+            return sum(entry[1] for (f, _), entry in self._entries.items()
+                       if f == fn)
+
+    def store(self, fn, name, value, priority=PRIORITY_DERIVED):
+        """
+        Cache a value for a file and evict to stay within budget
+        fn -- file the value was derived from
+        name -- name of the product, e.g. 'frame'
+        value -- arrays to cache
+        priority -- eviction priority, see PRIORITY_*
+        Returns value
+        """
+        size, count = sizeof(value), mapped(value)
+        with self._lock:
+            self._remove((fn, name))
+            self._entries[(fn, name)] = (value, size, priority, count)
+            self._usage += size
+            self._mapped += count
+            self._evict()
+        self._notify()
+        return value
+
+    def get(self, fn, name):
+        """
+        Return a cached value or None, marking it as recently used
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop((fn, name))
+            except KeyError:
+                return None
+            self._entries[(fn, name)] = entry
+            return entry[0]
+
+    def discard(self, fn, name=None):
+        """
+        Drop a cached value, or everything cached for a file if name is None
+        """
+        with self._lock:
+            if name is not None:
+                self._remove((fn, name))
+            else:
+                for key in [k for k in self._entries if k[0] == fn]:
+                    self._remove(key)
+        self._notify()
+
+    def pin(self, fn):
+        with self._lock:
+            self._pinned.add(fn)
+
+    def unpin(self, fn):
+        with self._lock:
+            self._pinned.discard(fn)
+            self._evict()
+        self._notify()
+
+    def loadFrame(self, fn):
+        """
+        Return the (data, header) of the first image in a file, decoding it
+        only if it is not already cached, see read_image
+        """
+        frame = self.get(fn, 'frame')
+        if frame is None:
+            data, header = read_image(fn)
+            if (self.downcast and data is not None and data.dtype.kind == 'f'
+                    and data.dtype.itemsize > 4):
+                data = data.astype(np.float32)
+            frame = self.store(fn, 'frame', (data, header), PRIORITY_FRAME)
+        return frame
+
+    def _remove(self, key):
+        try:
+            _, size, _, count = self._entries.pop(key)
+        except KeyError:
+            return
+        self._usage -= size
+        self._mapped -= count
+
+    def _evict(self):
+        while self._usage > self.budget or self._mapped > self.MaxMapped:
+            over_budget = self._usage > self.budget
+            candidates = [(priority, age, key) for age, (key, (_, size, priority, count))
+                          in enumerate(self._entries.items())
+                          if (size if over_budget else count) and key[0] not in self._pinned]
+            if not candidates:
+                return
+            self._remove(min(candidates)[2])
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+from collections import namedtuple
+import math
+import numpy as np
+import matplotlib
+import matplotlib.cm
+
+# Number of output rows rendered at a time, bounds the temporary memory used
+STRIP_ROWS = 256
+
+# Maximum number of pixels sampled when computing percentile cuts
+MAX_CUT_SAMPLES = 1000000
+
+RenderState = namedtuple('RenderState', ['lower_cut', 'upper_cut', 'scale', 'cmap'])
+
+
+def _linear(x, a):
+    return x
+
+
+def _log(x, a):
+    return np.log(x * a + 1, out=x) / np.log(a + 1)
+
+
+def _sqrt(x, a):
+    return np.sqrt(x, out=x)
+
+
+def _power(x, a):
+    return np.square(x, out=x)
+
+
+def _arcsinh(x, a):
+    return np.arcsinh(x / a, out=x) / np.arcsinh(1 / a)
+
+
+STRETCHES = {
+    'linear': _linear,
+    'log': _log,
+    'sqrt': _sqrt,
+    'power': _power,
+    'arcsinh': _arcsinh,
+}
+
+
+def stretch_parameters(vmin, vmax, scale):
+    """
+    Adjust percentile cuts the way aplpy's show_colorscale does so renders
+    match the FitsView display
+    vmin, vmax -- display cut values from the percentiles
+    scale -- stretch name, see STRETCHES
+    Returns (vmin, vmax, a, vmid), a is the stretch parameter and vmid the
+    reference level aplpy derives it from
+    """
+    vmid, a = None, None
+    if scale == 'log':
+        # aplpy needs vmid below vmin, difference frames go negative so the
+        # reference level is moved below the cuts like the arcsinh default
+        vmid = 0. if vmin > 0 else vmin - (vmax - vmin) / 30.
+        a = (vmax - vmid) / (vmin - vmid)
+    elif scale == 'arcsinh':
+        vmid = vmin - (vmax - vmin) / 30.
+        a = abs((vmid - vmin) / (vmax - vmin))
+    elif scale == 'linear':
+        # Automatic linear cuts are padded by 10%, vmax uses the padded vmin
+        vmin = vmin - 0.1 * (vmax - vmin)
+        vmax = vmax + 0.1 * (vmax - vmin)
+    return vmin, vmax, a, vmid
+
+
+def _colour_map(name):
+    try:
+        return matplotlib.colormaps[name]
+    except AttributeError:
+        return matplotlib.cm.get_cmap(name)
+
+
+def colour_table(cmap):
+    """
+    Build a 256 entry RGBA lookup table for a colour map
+    cmap -- colourmap name (see matplotlib.cm)
+    """
+    return _colour_map(cmap)(np.linspace(0, 1, 256), bytes=True)
+
+
+def cut_sample(data):
+    """
+    Return a sorted sample of the finite values in an image, large images are
+    sub-sampled on a regular grid. Keep it to recalculate cuts cheaply.
+    data -- 2D image array
+    """
+    step = max(1, int(math.ceil(math.sqrt(data.size / MAX_CUT_SAMPLES))))
+    sample = data[::step, ::step]
+    sample = sample[np.isfinite(sample)]
+    sample.sort()
+    return sample
+
+
+def sample_cuts(sample, lower, upper):
+    """
+    Calculate the display cut values from a sorted sample
+    sample -- sorted values, see cut_sample
+    lower -- percentage for the lower limit
+    upper -- percentage for the upper limit
+    Returns (vmin, vmax)
+    """
+    if sample.size == 0:
+        return 0., 1.
+    cuts = []
+    for percent in (lower, upper):
+        pos = min(max(percent, 0), 100) / 100 * (sample.size - 1)
+        i = int(pos)
+        j = min(i + 1, sample.size - 1)
+        cuts.append(float(sample[i] + (sample[j] - sample[i]) * (pos - i)))
+    vmin, vmax = cuts
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return vmin, vmax
+
+
+def percentile_cuts(data, lower, upper):
+    """
+    Calculate the display cut values for an image
+    data -- 2D image array
+    lower -- percentage for the lower limit
+    upper -- percentage for the upper limit
+    Returns (vmin, vmax)
+    """
+    return sample_cuts(cut_sample(data), lower, upper)
+
+
+def block_average(data, k):
+    """
+    Average image data in k by k blocks, partial blocks at the edges are
+    dropped
+    data -- 2D image array
+    k -- block size
+    Returns a new float32 array
+    """
+    if k <= 1:
+        return np.array(data, dtype=np.float32)
+    h, w = data.shape[0] // k * k, data.shape[1] // k * k
+    blocks = data[:h, :w].reshape(h // k, k, w // k, k)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def downsample(data, max_size):
+    """
+    Block average image data so neither side is larger than max_size
+    data -- 2D image array
+    max_size -- maximum width or height of the result
+    Returns a new float32 array
+    """
+    return block_average(data, int(math.ceil(max(data.shape) / max_size)))
+
+
+def normalise(data, vmin, vmax, scale):
+    """
+    Apply the display cuts and stretch to image data
+    data -- image array
+    vmin, vmax -- display cut values from the percentiles
+    scale -- stretch name, see STRETCHES
+    Returns float32 array of values between 0 and 1, NaN is preserved
+    """
+    vmin, vmax, a, _ = stretch_parameters(vmin, vmax, scale)
+    x = np.array(data, dtype=np.float32)
+    x -= vmin
+    x /= (vmax - vmin)
+    np.clip(x, 0, 1, out=x)
+    return STRETCHES[scale](x, a)
+
+
+def _sample_indices(start, stop, count):
+    """
+    Nearest neighbour indices resampling [start, stop) to count points
+    """
+    step = (stop - start) / count
+    return (start + (np.arange(count) + 0.5) * step).astype(np.intp)
+
+
+def render(data, state, shape=None, region=None, cuts=None, out=None):
+    """
+    Render image data to an RGBA array without going through a figure
+    data -- 2D image array
+    state -- RenderState describing the cuts, stretch and colour map
+    shape -- (height, width) of the output, defaults to the region size
+    region -- (x0, x1, y0, y1) array index bounds to render, defaults to all
+    cuts -- precomputed (vmin, vmax), calculated from data if omitted
+    out -- optional uint8 array of shape (height, width, 4) to render into
+    Returns the RGBA array, the first row is the top of the image
+    """
+    if region is None:
+        region = (0, data.shape[1], 0, data.shape[0])
+    x0, x1, y0, y1 = region
+    if shape is None:
+        shape = (y1 - y0, x1 - x0)
+    height, width = shape
+    if cuts is None:
+        cuts = percentile_cuts(data, state.lower_cut, state.upper_cut)
+    if out is None:
+        out = np.empty((height, width, 4), dtype=np.uint8)
+
+    table = colour_table(state.cmap)
+    rows = _sample_indices(y0, y1, height)[::-1]
+    cols = _sample_indices(x0, x1, width)
+    for start in range(0, height, STRIP_ROWS):
+        block = data[rows[start:start + STRIP_ROWS]][:, cols]
+        values = normalise(block, cuts[0], cuts[1], state.scale)
+        values *= 255
+        index = np.nan_to_num(values, copy=False).astype(np.uint8)
+        np.take(table, index, axis=0, out=out[start:start + STRIP_ROWS])
+    return out
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+"""
+from __future__ import print_function, unicode_literals, division
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import re
+import simplejson as json
+from .render import (RenderState, STRETCHES, render, colour_table,
+                     block_average, downsample, cut_sample, sample_cuts)
+from .memory import MemoryManager, PRIORITY_DERIVED, PRIORITY_PYRAMID
+from .export import encode_png
+
+# Display settings matching the FitsView defaults
+DEFAULT_STATE = RenderState(0.25, 99.75, 'log', 'gray')
+
+FITS_EXTENSIONS = ('.fits', '.fit')
+
+TILE_RE = re.compile(r'^/frames/([^/]+)/(\d+)/(\d+)/(\d+)\.png$')
+VIEW_RE = re.compile(r'^/frames/([^/]+)\.png$')
+INFO_RE = re.compile(r'^/frames/([^/]+)$')
+
+REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def parse_state(query):
+    """
+    Build a RenderState from URL query parameters, missing values take the
+    FitsView defaults
+    query -- dict as returned by urllib.parse.parse_qs
+    """
+    def param(name, default):
+        return query.get(name, [default])[-1]
+
+    try:
+        state = RenderState(float(param('lcut', DEFAULT_STATE.lower_cut)),
+                            float(param('ucut', DEFAULT_STATE.upper_cut)),
+                            param('scale', DEFAULT_STATE.scale),
+                            param('cmap', DEFAULT_STATE.cmap))
+    except ValueError:
+        raise HTTPError(400, 'invalid cut value')
+    if not (math.isfinite(state.lower_cut) and math.isfinite(state.upper_cut)):
+        raise HTTPError(400, 'invalid cut value')
+    if state.scale not in STRETCHES:
+        raise HTTPError(400, 'unknown scale {}'.format(state.scale))
+    try:
+        colour_table(state.cmap)
+    except (KeyError, ValueError):
+        raise HTTPError(400, 'unknown colour map {}'.format(state.cmap))
+    return state
+
+
+class TileServer(object):
+    """
+    Serves rendered PNG tiles and views of FITS images over HTTP using
+    asyncio. Rendering happens on a thread pool with a bounded number of
+    concurrent renders, and results are shared between clients through the
+    memory manager cache. Responses carry an ETag so clients can revalidate
+    with If-None-Match.
+
+    GET /frames                           JSON list of frame names, oldest first
+    GET /frames/<name>                    JSON frame size and pyramid levels
+    GET /frames/<name>.png?size=N         whole frame fitted into N pixels
+    GET /frames/<name>/<level>/<x>/<y>.png
+                                          tile, level 0 is full resolution and
+                                          tile 0, 0 is the top left
+
+    <name> is a file name, or 'latest' for the most recently modified file.
+    Every image takes the scale, cmap, lcut and ucut query parameters.
+    """
+    TileSize = 256
+    MaxViewSize = 4096
+    # Seconds a directory scan is reused before looking for new frames
+    ScanInterval = 2.0
+
+    def __init__(self, paths, memory=None, max_renders=None):
+        """
+        paths -- FITS files, or directories which are rescanned for new frames
+        memory -- MemoryManager for the shared cache
+        max_renders -- maximum number of renders running at once
+        """
+        self.paths = paths
+        self.memory = memory or MemoryManager()
+        self._max_renders = max_renders or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._max_renders)
+        self._renders = None
+        self._pending = {}
+        self._mtimes = {}
+        self._scan = None
+        self._scan_time = None
+
+    def _scanFrames(self):
+        """
+        Return an OrderedDict of frame name to (path, mtime), oldest first.
+        Files which disappear while scanning are skipped.
+        """
+        files = []
+        for path in self.paths:
+            try:
+                if os.path.isdir(path):
+                    files.extend(os.path.join(path, fn) for fn in os.listdir(path)
+                                 if fn.lower().endswith(FITS_EXTENSIONS))
+                elif os.path.isfile(path):
+                    files.append(path)
+            except OSError:
+                pass
+        frames = []
+        for fn in files:
+            try:
+                frames.append((os.path.getmtime(fn), fn))
+            except OSError:
+                pass
+        frames.sort()
+        return OrderedDict((os.path.basename(fn), (fn, mtime)) for mtime, fn in frames)
+
+    async def frames(self):
+        """
+        Return the frames as found by _scanFrames. Scans run off the event
+        loop, are shared by concurrent requests and reused for ScanInterval.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._scan is None or now - self._scan_time > self.ScanInterval:
+            self._scan = loop.run_in_executor(None, self._scanFrames)
+            self._scan_time = now
+        return await asyncio.shield(self._scan)
+
+    async def _framePath(self, name):
+        """
+        Return (path, mtime) for a frame name and drop stale cache entries if
+        the file has changed on disk
+        """
+        frames = await self.frames()
+        if name == 'latest' and frames:
+            path, mtime = next(reversed(frames.values()))
+        else:
+            path, mtime = frames.get(name, (None, None))
+        if path is None:
+            raise HTTPError(404, 'no frame {}'.format(name))
+        if self._mtimes.get(path) != mtime:
+            self.memory.discard(path)
+            self._mtimes[path] = mtime
+        return path, mtime
+
+    def _data(self, path):
+        data, _ = self.memory.loadFrame(path)
+        if data is None or data.ndim != 2:
+            raise HTTPError(404, 'no 2D image in {}'.format(os.path.basename(path)))
+        return data
+
+    def _levels(self, shape):
+        levels = 1
+        while max(shape) > self.TileSize << (levels - 1):
+            levels += 1
+        return levels
+
+    def _level(self, path, level):
+        """
+        Return the image at a pyramid level, each level is built by averaging
+        2x2 blocks of the one below and cached
+        """
+        if level == 0:
+            return self._data(path)
+        data = self.memory.get(path, ('level', level))
+        if data is None:
+            data = block_average(self._level(path, level - 1), 2)
+            self.memory.store(path, ('level', level), data, PRIORITY_PYRAMID)
+        return data
+
+    def _cuts(self, path, state):
+        """
+        Return cut values for the whole frame so every tile matches
+        """
+        sample = self.memory.get(path, 'cut_sample')
+        if sample is None:
+            sample = cut_sample(self._data(path))
+            self.memory.store(path, 'cut_sample', sample, PRIORITY_PYRAMID)
+        return sample_cuts(sample, state.lower_cut, state.upper_cut)
+
+    def _info(self, path):
+        height, width = self._data(path).shape
+        return json.dumps({
+            'name': os.path.basename(path),
+            'width': width,
+            'height': height,
+            'tile': self.TileSize,
+            'levels': self._levels((height, width)),
+        }).encode('utf-8')
+
+    def _renderTile(self, path, level, x, y, state):
+        if level >= self._levels(self._data(path).shape):
+            raise HTTPError(404, 'no level {}'.format(level))
+        data = self._level(path, level)
+        height, width = data.shape
+        x0, y1 = x * self.TileSize, height - y * self.TileSize
+        if x0 >= width or y1 <= 0:
+            raise HTTPError(404, 'tile outside image')
+        region = (x0, min(x0 + self.TileSize, width), max(y1 - self.TileSize, 0), y1)
+        return encode_png(render(data, state, region=region, cuts=self._cuts(path, state)))
+
+    def _renderView(self, path, size, state):
+        data = self._data(path)
+        view = self.memory.get(path, ('view', size))
+        if view is None:
+            view = downsample(data, size)
+            self.memory.store(path, ('view', size), view, PRIORITY_PYRAMID)
+        return encode_png(render(view, state, cuts=self._cuts(path, state)))
+
+    async def _cached(self, path, key, func, *args):
+        """
+        Return a rendered product from the cache, or render it once however
+        many clients ask for it at the same time
+        key -- name of the product, including the file modification time so
+               a render of an older version is never served for a newer one
+        """
+        body = self.memory.get(path, key)
+        if body is not None:
+            return body
+        future = self._pending.get((path, key))
+        if future is None:
+            future = asyncio.ensure_future(self._render(path, key, func, *args))
+            self._pending[(path, key)] = future
+            future.add_done_callback(lambda f: self._pending.pop((path, key), None))
+        # A client going away must not cancel a render others are waiting on
+        return await asyncio.shield(future)
+
+    async def _render(self, path, key, func, *args):
+        async with self._renders:
+            loop = asyncio.get_running_loop()
+            body = await loop.run_in_executor(self._executor, func, *args)
+        self.memory.store(path, key, body, PRIORITY_DERIVED)
+        return body
+
+    async def _image(self, path, mtime, key, headers, func, *args):
+        """
+        Return (status, content type, etag, body) for a rendered image. The
+        ETag only depends on the file and request, so a matching
+        If-None-Match is answered without rendering.
+        """
+        etag = '"{}"'.format(hashlib.sha1(repr((path, mtime, key)).encode('utf-8')).hexdigest())
+        if etag in headers.get('if-none-match', ''):
+            return 304, 'image/png', etag, b''
+        body = await self._cached(path, (key, mtime), func, *args)
+        return 200, 'image/png', etag, body
+
+    async def _route(self, target, headers):
+        """
+        Return (status, content type, etag, body) for a request target
+        """
+        url = urlsplit(target)
+        route = unquote(url.path).rstrip('/')
+        query = parse_qs(url.query)
+
+        if route in ('', '/frames'):
+            body = json.dumps(list((await self.frames()).keys())).encode('utf-8')
+            return 200, 'application/json', None, body
+
+        match = TILE_RE.match(route)
+        if match:
+            name, level, x, y = match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4))
+            path, mtime = await self._framePath(name)
+            state = parse_state(query)
+            return await self._image(path, mtime, ('tile', level, x, y, state), headers,
+                                     self._renderTile, path, level, x, y, state)
+
+        match = VIEW_RE.match(route)
+        if match:
+            path, mtime = await self._framePath(match.group(1))
+            state = parse_state(query)
+            try:
+                size = int(query.get('size', [1024])[-1])
+            except ValueError:
+                raise HTTPError(400, 'invalid size')
+            size = min(max(size, 1), self.MaxViewSize)
+            return await self._image(path, mtime, ('view.png', size, state), headers,
+                                     self._renderView, path, size, state)
+
+        match = INFO_RE.match(route)
+        if match:
+            path, _ = await self._framePath(match.group(1))
+            body = await self._cached(path, 'info', self._info, path)
+            return 200, 'application/json', None, body
+
+        raise HTTPError(404, 'no route {}'.format(route))
+
+    async def _handle(self, reader, writer):
+        """
+        Answer a single HTTP request on a connection
+        """
+        method = 'GET'
+        headers = {}
+        etag = None
+        content_type = 'text/plain; charset=utf-8'
+        try:
+            request = await reader.readline()
+            try:
+                method, target, _ = request.decode('latin-1').split(' ', 2)
+            except ValueError:
+                raise HTTPError(400, 'malformed request line')
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if method not in ('GET', 'HEAD'):
+                raise HTTPError(405, 'only GET and HEAD are supported')
+            status, content_type, etag, body = await self._route(target, headers)
+        except HTTPError as e:
+            status, body = e.status, str(e).encode('utf-8')
+        except Exception:
+            logging.exception('error serving request')
+            status, body = 500, b'internal error'
+
+        response = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, 'Internal Server Error')),
+                    'Content-Type: {}'.format(content_type),
+                    'Content-Length: {}'.format(len(body)),
+                    'Cache-Control: no-cache',
+                    'Connection: close']
+        if etag is not None:
+            response.append('ETag: {}'.format(etag))
+        writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Start listening, returns the asyncio server
+        """
+        self._renders = asyncio.Semaphore(self._max_renders)
+        return await asyncio.start_server(self._handle, host, port)
+
+
+def serve(paths, host='127.0.0.1', port=8080, memory=None, max_renders=None):
+    """
+    Run a tile server until interrupted
+    paths -- FITS files, or directories of FITS files
+    host -- address to listen on, only the local machine by default
+    port -- TCP port to listen on
+    """
+    async def run():
+        server = await TileServer(paths, memory, max_renders).start(host, port)
+        logging.warning('serving FITS tiles on http://{}:{}/'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
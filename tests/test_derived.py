@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for difference and ratio frames
+"""
+from __future__ import print_function, unicode_literals, division
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import astropy.io.fits as fits
+from astropy.wcs import WCS
+from fitsview.derived import combine, derived_frame, wcs_shift
+from fitsview.memory import MemoryManager
+
+
+def celestial_header(shape, crpix):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150., 20.]
+    wcs.wcs.crpix = crpix
+    wcs.wcs.cdelt = [-1e-3, 1e-3]
+    header = wcs.to_header()
+    header['NAXIS'] = 2
+    header['NAXIS1'], header['NAXIS2'] = shape[1], shape[0]
+    return header
+
+
+class CombineTest(unittest.TestCase):
+
+    def test_uint16_difference(self):
+        data = np.array([[0, 10], [65535, 3]], dtype=np.uint16)
+        ref = np.array([[5, 4], [0, 65535]], dtype=np.uint16)
+        out = combine(data, ref, 'difference')
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_array_equal(out, [[-5, 6], [65535, -65532]])
+
+    def test_ratio_zero_reference(self):
+        data = np.array([[1, 0], [4, 2]], dtype=np.float32)
+        ref = np.array([[0, 0], [2, 4]], dtype=np.float32)
+        out = combine(data, ref, 'ratio')
+        self.assertTrue(np.isnan(out[0]).all())
+        np.testing.assert_array_equal(out[1], [2, 0.5])
+
+    def test_shifted_overlap(self):
+        data = np.arange(20, dtype=np.float32).reshape(4, 5)
+        out = combine(data, data, 'difference', dy=1, dx=-2)
+        # Only rows 0-2 and columns 2-4 overlap the shifted reference
+        self.assertTrue(np.isnan(out[3]).all())
+        self.assertTrue(np.isnan(out[:, :2]).all())
+        np.testing.assert_array_equal(out[:3, 2:], np.full((3, 3), -3))
+
+
+class AlignTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_wcs_shift(self):
+        # The same sky position sits 3 columns right and 2 rows down in the
+        # reference frame
+        header = celestial_header((40, 50), [20., 20.])
+        ref_header = celestial_header((40, 50), [23., 18.])
+        self.assertEqual(wcs_shift(header, ref_header), (-2, 3))
+        self.assertEqual(wcs_shift(fits.Header(), ref_header), (0, 0))
+
+    def test_aligned_difference(self):
+        sky = np.random.RandomState(3).randint(0, 1000, size=(44, 56)).astype(np.uint16)
+        data, ref = sky[2:42, 0:50], sky[4:44, 3:53]
+        fn, reference = os.path.join(self.dir, 'a.fits'), os.path.join(self.dir, 'b.fits')
+        fits.PrimaryHDU(data, celestial_header(data.shape, [20., 20.])).writeto(fn)
+        fits.PrimaryHDU(ref, celestial_header(ref.shape, [17., 18.])).writeto(reference)
+        out, _ = derived_frame(MemoryManager(), fn, reference, 'difference', align=True)
+        overlap = np.isfinite(out)
+        self.assertEqual(overlap.sum(), 38 * 47)
+        np.testing.assert_array_equal(out[overlap], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
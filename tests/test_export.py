@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for saving frames to FITS
+"""
+from __future__ import print_function, unicode_literals, division
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import astropy.io.fits as fits
+from fitsview.export import write_fits, WRITE_ROWS
+
+
+class WriteFitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'out.fits')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def roundTrip(self, data, header=None):
+        write_fits(self.fn, data, header or fits.Header())
+        # Read the header separately, astropy drops BZERO once data is scaled
+        with fits.open(self.fn) as hdul:
+            return hdul[0].data.copy(), fits.getheader(self.fn)
+
+    def test_uint16(self):
+        # Taller than one write block so streaming is exercised
+        data = (np.arange((WRITE_ROWS + 10) * 7) % 65536).astype(np.uint16)
+        data = data.reshape(-1, 7)
+        data[0, 0], data[0, 1] = 0, 65535
+        header = fits.Header([('OBJECT', 'M31'), ('BZERO', 5), ('BSCALE', 2)])
+        result, header = self.roundTrip(data, header)
+        self.assertEqual(result.dtype, np.uint16)
+        np.testing.assert_array_equal(result, data)
+        self.assertEqual((header['BITPIX'], header['BZERO']), (16, 2**15))
+        self.assertEqual(header['OBJECT'], 'M31')
+
+    def test_int8(self):
+        data = np.array([[-128, -1, 0], [1, 64, 127]], dtype=np.int8)
+        result, header = self.roundTrip(data)
+        self.assertEqual(result.dtype, np.int8)
+        np.testing.assert_array_equal(result, data)
+        self.assertEqual((header['BITPIX'], header['BZERO']), (8, -2**7))
+
+    def test_bool(self):
+        data = np.array([[True, False], [False, True]])
+        result, header = self.roundTrip(data)
+        np.testing.assert_array_equal(result, data.astype(np.uint8))
+        self.assertEqual(header['BITPIX'], 8)
+        self.assertNotIn('BZERO', header)
+
+    def test_float_big_endian(self):
+        data = np.linspace(-1, 1, 12, dtype='>f8').reshape(3, 4)
+        result, header = self.roundTrip(data)
+        np.testing.assert_array_equal(result, data)
+        self.assertEqual(header['BITPIX'], -64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the memory budget manager
+"""
+from __future__ import print_function, unicode_literals, division
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import astropy.io.fits as fits
+from fitsview.memory import (MemoryManager, PRIORITY_DERIVED, PRIORITY_PYRAMID,
+                             PRIORITY_FRAME, read_image, mapped)
+
+
+def block(kb):
+    return np.zeros(kb * 1024, dtype=np.uint8)
+
+
+class EvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = MemoryManager(budget=10 * 1024)
+
+    def cached(self):
+        return [(fn, name) for fn in 'abc' for name in ('frame', 'preview', 'diff')
+                if self.memory.get(fn, name) is not None]
+
+    def test_priority_then_lru(self):
+        self.memory.store('a', 'diff', block(3), PRIORITY_DERIVED)
+        self.memory.store('b', 'diff', block(3), PRIORITY_DERIVED)
+        self.memory.store('a', 'preview', block(3), PRIORITY_PYRAMID)
+        self.memory.get('a', 'diff')
+        # Needs room for one more block, the least recently used derived
+        # product goes first even though it is not the oldest entry
+        self.memory.store('c', 'frame', block(3), PRIORITY_FRAME)
+        self.assertEqual(self.cached(), [('a', 'preview'), ('a', 'diff'), ('c', 'frame')])
+        # Then the remaining derived product before any preview
+        self.memory.store('b', 'frame', block(3), PRIORITY_FRAME)
+        self.assertEqual(self.cached(), [('a', 'preview'), ('b', 'frame'), ('c', 'frame')])
+        self.assertEqual(self.memory.usage(), 9 * 1024)
+
+    def test_pinned_never_evicted(self):
+        self.memory.pin('a')
+        self.memory.store('a', 'diff', block(6), PRIORITY_DERIVED)
+        self.memory.store('b', 'frame', block(6), PRIORITY_FRAME)
+        self.assertEqual(self.cached(), [('a', 'diff')])
+        # Over budget with only pinned entries left is allowed
+        self.memory.store('a', 'frame', block(6), PRIORITY_FRAME)
+        self.assertEqual(self.cached(), [('a', 'frame'), ('a', 'diff')])
+        self.memory.unpin('a')
+        self.assertEqual(self.cached(), [('a', 'frame')])
+
+    def test_listeners(self):
+        calls = []
+        self.memory.addListener(lambda usage, budget: calls.append((usage, budget)))
+        self.memory.store('a', 'frame', block(1))
+        self.memory.discard('a')
+        self.assertEqual(calls, [(1024, 10 * 1024), (0, 10 * 1024)])
+
+
+class FrameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.memory = MemoryManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_mapped_cap(self):
+        self.memory.MaxMapped = 3
+        data = np.arange(64, dtype=np.float32).reshape(8, 8)
+        for i in range(5):
+            fits.PrimaryHDU(data).writeto(self.path('{}.fits'.format(i)))
+            frame = self.memory.loadFrame(self.path('{}.fits'.format(i)))
+            self.assertEqual(mapped(frame), 1)
+        loaded = [i for i in range(5)
+                  if self.memory.get(self.path('{}.fits'.format(i)), 'frame') is not None]
+        self.assertEqual(loaded, [2, 3, 4])
+
+    def test_scaled_fallback(self):
+        data = np.array([[0, 1], [40000, 65535]], dtype=np.uint16)
+        fits.PrimaryHDU(data).writeto(self.path('scaled.fits'))
+        frame, header = self.memory.loadFrame(self.path('scaled.fits'))
+        self.assertEqual(frame.dtype, np.uint16)
+        np.testing.assert_array_equal(frame, data)
+
+    def test_first_image_hdu(self):
+        data = np.arange(12, dtype=np.float32).reshape(3, 4)
+        hdus = [fits.PrimaryHDU(), fits.BinTableHDU.from_columns(
+            [fits.Column(name='x', format='E', array=np.zeros(2))]),
+            fits.CompImageHDU(data), fits.ImageHDU(data * 2)]
+        fits.HDUList(hdus).writeto(self.path('multi.fits'))
+        frame, header = read_image(self.path('multi.fits'))
+        np.testing.assert_array_equal(frame, data)
+        fits.PrimaryHDU().writeto(self.path('empty.fits'))
+        self.assertIsNone(read_image(self.path('empty.fits'))[0])
+
+    def test_downcast_drops_cache(self):
+        data = np.arange(4, dtype=np.float64).reshape(2, 2)
+        fits.PrimaryHDU(data).writeto(self.path('double.fits'))
+        fn = self.path('double.fits')
+        self.assertEqual(self.memory.loadFrame(fn)[0].dtype.name, 'float64')
+        self.memory.store(fn, 'preview', block(1))
+        self.memory.setDowncast(True)
+        self.assertIsNone(self.memory.get(fn, 'preview'))
+        self.assertEqual(self.memory.loadFrame(fn)[0].dtype.name, 'float32')
+        self.memory.setDowncast(False)
+        self.assertEqual(self.memory.loadFrame(fn)[0].dtype.name, 'float64')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the offscreen renderer, checked against the aplpy display
+"""
+from __future__ import print_function, unicode_literals, division
+import unittest
+import numpy as np
+import astropy.io.fits as fits
+from fitsview.render import (RenderState, normalise, percentile_cuts, render,
+                             stretch_parameters)
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import aplpy
+except ImportError:
+    aplpy = None
+
+
+@unittest.skipIf(aplpy is None, 'aplpy is not installed')
+class NormaliseTest(unittest.TestCase):
+
+    def setUp(self):
+        # Small enough that aplpy computes exact percentiles without sampling
+        rng = np.random.RandomState(7)
+        self.data = rng.lognormal(3, 1, size=(60, 50)).astype(np.float32)
+        self.fig = aplpy.FITSFigure(fits.PrimaryHDU(self.data))
+
+    def tearDown(self):
+        self.fig.close()
+
+    def displayed(self, cuts, **kwargs):
+        self.fig.show_colorscale(**kwargs)
+        # aplpy stretches before clipping, so values below the cuts can wrap
+        # around in the power stretch, only compare the displayed range
+        inside = (self.data >= cuts[0]) & (self.data <= cuts[1])
+        return np.clip(self.fig.image.norm(self.data), 0, 1), inside
+
+    def test_automatic_cuts(self):
+        for scale in ['linear', 'log', 'sqrt', 'power', 'arcsinh']:
+            vmin, vmax = percentile_cuts(self.data, 1, 99)
+            expected, inside = self.displayed((vmin, vmax), pmin=1, pmax=99, stretch=scale)
+            actual = normalise(self.data, vmin, vmax, scale)
+            np.testing.assert_allclose(actual[inside], expected[inside], atol=1e-5,
+                                       err_msg=scale)
+
+    def test_explicit_cuts(self):
+        vmin, vmax = percentile_cuts(self.data, 5, 95)
+        for scale in ['linear', 'log', 'arcsinh']:
+            lo, hi, _, vmid = stretch_parameters(vmin, vmax, scale)
+            expected, inside = self.displayed((vmin, vmax), vmin=lo, vmid=vmid,
+                                              vmax=hi, stretch=scale)
+            actual = normalise(self.data, vmin, vmax, scale)
+            np.testing.assert_allclose(actual[inside], expected[inside], atol=1e-5,
+                                       err_msg=scale)
+
+    def test_negative_log(self):
+        # Difference frames are centred on zero, aplpy raises for a log
+        # stretch unless it is given a reference level below the cuts
+        data = self.data - np.median(self.data)
+        vmin, vmax = percentile_cuts(data, 0.25, 99.75)
+        lo, hi, _, vmid = stretch_parameters(vmin, vmax, 'log')
+        self.fig.show_colorscale(vmin=lo, vmid=vmid, vmax=hi, stretch='log')
+        expected = np.clip(self.fig.image.norm(data), 0, 1)
+        np.testing.assert_allclose(normalise(data, vmin, vmax, 'log'), expected, atol=1e-5)
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_flat_log(self):
+        data = np.zeros((4, 4), dtype=np.float32)
+        vmin, vmax = percentile_cuts(data, 0.25, 99.75)
+        self.assertTrue(np.isfinite(normalise(data, vmin, vmax, 'log')).all())
+
+
+    def test_region_and_shape(self):
+        data = np.arange(40 * 30, dtype=np.float32).reshape(40, 30)
+        rgba = render(data, RenderState(0, 100, 'linear', 'gray'),
+                      shape=(20, 10), region=(0, 10, 0, 20))
+        self.assertEqual(rgba.shape, (20, 10, 4))
+        self.assertEqual(rgba.dtype, np.uint8)
+        # The top row of the output is the highest row of the region
+        self.assertGreater(rgba[0, 0, 0], rgba[-1, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
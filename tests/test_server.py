@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the tile server, run against localhost only
+"""
+from __future__ import print_function, unicode_literals, division
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import numpy as np
+import astropy.io.fits as fits
+import simplejson as json
+from fitsview.server import TileServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+async def fetch(port, target, headers=None, method='GET'):
+    """
+    Make one HTTP request to the server, returns (status, headers, body)
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = ['{} {} HTTP/1.1'.format(method, target), 'Host: localhost']
+    request.extend('{}: {}'.format(k, v) for k, v in (headers or {}).items())
+    writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = dict((k.strip().lower(), v.strip())
+                   for k, _, v in (line.partition(':') for line in lines[1:]))
+    return status, headers, body
+
+
+class TileServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        data = (np.arange(600 * 500) % 4000).reshape(600, 500).astype(np.uint16)
+        fits.PrimaryHDU(data).writeto(os.path.join(self.dir, 'first.fits'))
+        fits.PrimaryHDU(data.astype(np.float32)).writeto(os.path.join(self.dir, 'second.fits'))
+        os.utime(os.path.join(self.dir, 'first.fits'), (1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_requests(self, func):
+        async def run():
+            server = await TileServer([self.dir]).start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await func(port)
+            finally:
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(run())
+
+    def test_frames(self):
+        async def requests(port):
+            return (await fetch(port, '/frames'), await fetch(port, '/frames/latest'))
+        (status, _, body), (info_status, _, info) = self.run_requests(requests)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), ['first.fits', 'second.fits'])
+        self.assertEqual(info_status, 200)
+        info = json.loads(info)
+        self.assertEqual(info['name'], 'second.fits')
+        self.assertEqual((info['width'], info['height'], info['levels']), (500, 600, 3))
+
+    def test_tile_revalidation(self):
+        async def requests(port):
+            first = await fetch(port, '/frames/first.fits/0/1/2.png?cmap=viridis')
+            etag = first[1]['etag']
+            again = await fetch(port, '/frames/first.fits/0/1/2.png?cmap=viridis',
+                                {'If-None-Match': etag})
+            other = await fetch(port, '/frames/first.fits/0/1/2.png?cmap=gray',
+                                {'If-None-Match': etag})
+            return first, again, other
+        first, again, other = self.run_requests(requests)
+        self.assertEqual(first[0], 200)
+        self.assertEqual(first[1]['content-type'], 'image/png')
+        self.assertTrue(first[2].startswith(PNG_SIGNATURE))
+        self.assertEqual(again[0], 304)
+        self.assertEqual(again[2], b'')
+        self.assertEqual(other[0], 200)
+
+    def test_view(self):
+        async def requests(port):
+            return await fetch(port, '/frames/latest.png?size=100&scale=linear')
+        status, headers, body = self.run_requests(requests)
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(PNG_SIGNATURE))
+        self.assertIn('etag', headers)
+
+    def test_errors(self):
+        async def requests(port):
+            targets = ['/frames/missing.fits', '/frames/first.fits/5/0/0.png',
+                       '/frames/first.fits/0/9/0.png', '/frames/first.fits.png?cmap=nope',
+                       '/frames/first.fits.png?scale=nope', '/frames/first.fits.png?lcut=nan',
+                       '/frames/first.fits.png?ucut=inf', '/nowhere']
+            statuses = [(await fetch(port, target))[0] for target in targets]
+            statuses.append((await fetch(port, '/frames', method='POST'))[0])
+            return statuses
+        self.assertEqual(self.run_requests(requests), [404, 404, 404, 400, 400, 400, 400, 404, 405])
+
+    def test_modified_frame(self):
+        fn = os.path.join(self.dir, 'first.fits')
+
+        async def requests(port):
+            first = await fetch(port, '/frames/first.fits.png?size=50')
+            fits.PrimaryHDU(np.full((600, 500), 7, dtype=np.uint16)).writeto(fn, overwrite=True)
+            os.utime(fn, (2, 2))
+            await asyncio.sleep(TileServer.ScanInterval + 0.1)
+            return first, await fetch(port, '/frames/first.fits.png?size=50')
+        first, second = self.run_requests(requests)
+        self.assertEqual((first[0], second[0]), (200, 200))
+        self.assertNotEqual(first[1]['etag'], second[1]['etag'])
+        self.assertNotEqual(first[2], second[2])
+
+    def test_concurrent_tiles(self):
+        async def requests(port):
+            targets = ['/frames/second.fits/{}/0/0.png'.format(i % 3) for i in range(12)]
+            return await asyncio.gather(*[fetch(port, target) for target in targets])
+        responses = self.run_requests(requests)
+        self.assertEqual([r[0] for r in responses], [200] * 12)
+
+    def test_import_without_qt(self):
+        code = 'import sys, fitsview.server; sys.exit("PyQt5" in sys.modules)'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], cwd=root), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()